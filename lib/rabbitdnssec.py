@@ -9,15 +9,36 @@
 import sys
 import socket
 import time
+import random
 import os.path
+import stat
+import fcntl
+import types
+import struct
 import importlib
+import cStringIO
 
 import ssl
 import json
+import zlib
+import hashlib
+import sqlite3
 import syslog
+import signal
+import threading
+import select
+import xml.etree.cElementTree as ElementTree
 import atexit
+import collections
+import copy
 import configparser
 
+import dns.name
+import dns.rdata
+import dns.rdatatype
+import dns.rrset
+import dns.dnssec
+
 import pika
 import pika.spec
 import pika.credentials
@@ -63,6 +84,8 @@ backup_machines =      appcfg ['rabbitmq'] ['backup_machines'].split ()
 plugindir       =      appcfg ['rabbitmq'] ['plugindir']
 ca_certs	=      appcfg ['rabbitmq'] ['ca_certs']
 backend         =      appcfg ['rabbitmq'] ['backend']
+heartbeat       = int   (appcfg ['rabbitmq'].get ('heartbeat',     '60'))
+reconnect_max   = float (appcfg ['rabbitmq'].get ('reconnect_max', '60'))
 #
 assert ((this_machine in signer_machines) or (this_machine in backup_machines))
 assert (len (signer_machines) >= 2)
@@ -87,46 +110,188 @@ pkcs11_curve_name	= appcfg ['pkcs11'] ['curve_name']
 
 # Send messages at various levels to syslog
 #
-def log_debug (msg, *args):
+# Messages below the configured loglevel are dropped before any of
+# their arguments is formatted, so it is cheap to log_debug() with
+# large objects such as RRsets.  Identical messages are rate limited
+# to log_burst per log_interval seconds; the number of suppressed
+# repeats is reported when the interval has passed.
+#
+loglevels = {
+	'debug':	syslog.LOG_DEBUG,
+	'info':		syslog.LOG_INFO,
+	'notice':	syslog.LOG_NOTICE,
+	'warning':	syslog.LOG_WARNING,
+	'error':	syslog.LOG_ERR,
+	'critical':	syslog.LOG_CRIT,
+}
+loglevel     = loglevels [appcfg ['rabbitmq'].get ('loglevel', 'debug')]
+log_burst    = int   (appcfg ['rabbitmq'].get ('log_burst',    '10'))
+log_interval = float (appcfg ['rabbitmq'].get ('log_interval', '60'))
+
+# Map (level,msg) to [window_start,count] for rate limiting.
+# Expired entries are pruned beyond 1000 entries, at most once per
+# log_interval so that logging many distinct messages stays cheap,
+# and the map is emptied when it grows beyond 10000 entries anyway.
+log_recent = { }
+log_pruned = 0
+
+def _log (level, msg, args):
+	global log_pruned
+	if level > loglevel:
+		return
 	for a in args:
 		msg = msg + ' ' + unicode (str (a), 'utf-8')
 	msg = msg.encode ('ascii', 'replace')
-	syslog.syslog (syslog.LOG_DEBUG, msg)
+	now = time.time ()
+	if len (log_recent) > 10000 or (len (log_recent) > 1000 and now - log_pruned >= log_interval):
+		log_pruned = now
+		overflow = len (log_recent) > 10000
+		for ((lvl,txt),(start,count)) in log_recent.items ():
+			if overflow or now - start >= log_interval:
+				if count > log_burst:
+					syslog.syslog (lvl, 'Suppressed %d repeats of: %s' % (count - log_burst, txt))
+				log_recent.pop ((lvl,txt), None)
+	recent = log_recent.get ((level,msg))
+	if recent is None or now - recent [0] >= log_interval:
+		if recent is not None and recent [1] > log_burst:
+			syslog.syslog (level, 'Suppressed %d repeats of: %s' % (recent [1] - log_burst, msg))
+		log_recent [(level,msg)] = [now, 1]
+	else:
+		recent [1] += 1
+		if recent [1] > log_burst:
+			return
+	syslog.syslog (level, msg)
+
+def log_debug (msg, *args):
+	_log (syslog.LOG_DEBUG, msg, args)
 
 def log_info (msg, *args):
-	for a in args:
-		msg = msg + ' ' + unicode (str (a), 'utf-8')
-	# msg = msg % tuple (map (str, args))
-	msg = msg.encode ('ascii', 'replace')
-	syslog.syslog (syslog.LOG_INFO, msg)
+	_log (syslog.LOG_INFO, msg, args)
 
 def log_notice (msg, *args):
-	for a in args:
-		msg = msg + ' ' + unicode (str (a), 'utf-8')
-	# msg = msg % tuple (map (str, args))
-	msg = msg.encode ('ascii', 'replace')
-	syslog.syslog (syslog.LOG_NOTICE, msg)
+	_log (syslog.LOG_NOTICE, msg, args)
 
 def log_warning (msg, *args):
-	for a in args:
-		msg = msg + ' ' + unicode (str (a), 'utf-8')
-	# msg = msg % tuple (map (str, args))
-	msg = msg.encode ('ascii', 'replace')
-	syslog.syslog (syslog.LOG_WARNING, msg)
+	_log (syslog.LOG_WARNING, msg, args)
 
 def log_error (msg, *args):
-	for a in args:
-		msg = msg + ' ' + unicode (str (a), 'utf-8')
-	# msg = msg % tuple (map (str, args))
-	msg = msg.encode ('ascii', 'replace')
-	syslog.syslog (syslog.LOG_ERR, msg)
+	_log (syslog.LOG_ERR, msg, args)
 
 def log_critical (msg, *args):
-	for a in args:
-		msg = msg + ' ' + unicode (str (a), 'utf-8')
-	# msg = msg % tuple (map (str, args))
-	msg = msg.encode ('ascii', 'replace')
-	syslog.syslog (syslog.LOG_CRIT, msg)
+	_log (syslog.LOG_CRIT, msg, args)
+
+# Metrics for the daemons, in the form of counters and histograms.
+# They are exported as a Prometheus textfile <metrics_dir>/<appname>.prom
+# for the textfile collector of node_exporter, but only when the
+# [rabbitmq] section sets metrics_dir.  The file is replaced atomically
+# at most once per metrics_interval seconds, and once more at exit.
+#
+metrics_dir      =        appcfg ['rabbitmq'].get ('metrics_dir', None)
+metrics_interval = float (appcfg ['rabbitmq'].get ('metrics_interval', '15'))
+metric_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+# Map (name,labels) to a value, or to [bucketcounts,sum,count]
+metric_counters   = { }
+metric_histograms = { }
+metrics_written = 0
+
+# Metrics may be updated from background threads, such as a Debouncer
+metrics_lock = threading.RLock ()
+
+def _metric_key (name, labels):
+	return (name, tuple (sorted (labels.items ())))
+
+def _metric_labels (labels, *extra):
+	labels = (('app',appname),) + labels + extra
+	return '{' + ','.join ([
+		'%s="%s"' % (k, str (v).replace ('\\', '\\\\').replace ('"', '\\"').replace ('\n', '\\n'))
+		for (k,v) in labels ]) + '}'
+
+# Add to a counter, which is identified by name and labels.
+#
+def metric_count (name, inc=1, **labels):
+	key = _metric_key (name, labels)
+	with metrics_lock:
+		metric_counters [key] = metric_counters.get (key, 0) + inc
+		metrics_flush ()
+
+# Add an observation, usually in seconds, to a histogram.
+#
+def metric_observe (name, value, **labels):
+	key = _metric_key (name, labels)
+	with metrics_lock:
+		hist = metric_histograms.get (key)
+		if hist is None:
+			hist = [ [0] * len (metric_buckets), 0.0, 0 ]
+			metric_histograms [key] = hist
+		for i in range (len (metric_buckets)):
+			if value <= metric_buckets [i]:
+				hist [0] [i] += 1
+		hist [1] += value
+		hist [2] += 1
+		metrics_flush ()
+
+class MetricTimer (object):
+	"""Context manager that observes the seconds spent in its
+	   body into a histogram, for example for a processing stage:
+
+	   with rabbitdnssec.MetricTimer ('stage_seconds', stage='parse'):
+	   	...
+	"""
+
+	def __init__ (self, name, **labels):
+		self.name = name
+		self.labels = labels
+
+	def __enter__ (self):
+		self.start = time.time ()
+		return self
+
+	def __exit__ (self, exc_type, exc_value, traceback):
+		metric_observe (self.name, time.time () - self.start, **self.labels)
+		return False
+
+# Write the metrics to the textfile, unless this was done recently.
+#
+def metrics_flush (force=False):
+	with metrics_lock:
+		_metrics_flush (force)
+
+def _metrics_flush (force):
+	global metrics_written
+	if metrics_dir is None:
+		return
+	now = time.time ()
+	if not force and now - metrics_written < metrics_interval:
+		return
+	metrics_written = now
+	lines = [ ]
+	for name in sorted (set ([ n for (n,_) in metric_counters.keys () ])):
+		lines.append ('# TYPE rabbitdnssec_%s counter' % name)
+		for ((n,labels),value) in sorted (metric_counters.items ()):
+			if n == name:
+				lines.append ('rabbitdnssec_%s%s %r' % (name, _metric_labels (labels), float (value)))
+	for name in sorted (set ([ n for (n,_) in metric_histograms.keys () ])):
+		lines.append ('# TYPE rabbitdnssec_%s histogram' % name)
+		for ((n,labels),(buckets,total,count)) in sorted (metric_histograms.items ()):
+			if n != name:
+				continue
+			for i in range (len (metric_buckets)):
+				lines.append ('rabbitdnssec_%s_bucket%s %d' % (name, _metric_labels (labels, ('le',repr (metric_buckets [i]))), buckets [i]))
+			lines.append ('rabbitdnssec_%s_bucket%s %d' % (name, _metric_labels (labels, ('le','+Inf')), count))
+			lines.append ('rabbitdnssec_%s_sum%s %r'   % (name, _metric_labels (labels), total))
+			lines.append ('rabbitdnssec_%s_count%s %d' % (name, _metric_labels (labels), count))
+	promfile = os.path.join (metrics_dir, appname + '.prom')
+	tmpfile = promfile + '.' + str (os.getpid ())
+	try:
+		fh = open (tmpfile, 'w')
+		fh.write ('\n'.join (lines) + '\n')
+		fh.close ()
+		os.rename (tmpfile, promfile)
+	except (IOError, OSError), e:
+		log_warning ('Failed to write metrics to', promfile, e)
+
+atexit.register (metrics_flush, True)
 
 # Return the name of a queue on the current machine (prefix by hostname)
 #
@@ -171,6 +336,205 @@ def my_backendmod (modname_prefix, modname_postfix='', ovr_appname=None):
 	sys.path.pop ()
 	return backendmod
 
+# Helper programs are commands such as ods-zonedata-signconf that
+# are also run from the daemons, for one or a few zones at a time.
+# Rather than forking a new Python process for each zone, which
+# would load all modules and the configuration again, they can be
+# loaded once as a module with my_helper() and be run in-process
+# with run_helper().  Such helper programs guard their main code
+# with a test for __name__ == '__main__' and offer it as main(args).
+#
+helper_modules = { }
+
+# Return a helper program as a module, loading it on first use.
+# The program is found in the directories on $PATH, which starts
+# with our own prefix.
+#
+def my_helper (helpername):
+	if not helper_modules.has_key (helpername):
+		helperpath = None
+		for bindir in os.environ ['PATH'].split (':'):
+			candidate = os.path.join (bindir or os.curdir, helpername)
+			if os.path.isfile (candidate):
+				helperpath = candidate
+				break
+		if helperpath is None:
+			raise ImportError ('Helper program not found: ' + helpername)
+		helpermod = types.ModuleType (helpername.replace ('-', '_'))
+		helpermod.__file__ = helperpath
+		helpercode = compile (open (helperpath).read (), helperpath, 'exec')
+		exec (helpercode, helpermod.__dict__)
+		helper_modules [helpername] = helpermod
+		log_debug ('Loaded helper program', helperpath)
+	return helper_modules [helpername]
+
+# Run a helper program in-process with the given arguments, and
+# return its exit code like a command would.  Exceptions are logged
+# and reported as a failure exit code, and so is the SystemExit from
+# the helper's own sys.exit().  Signal handlers must therefore not
+# raise SystemExit, or it would be taken as a helper's exit code; the
+# one for SIGTERM only sets a flag.  Helpers share resources such
+# as the PKCS #11 session, so they run one at a time, even when they
+# are called from a Debouncer thread.
+#
+helper_lock = threading.RLock ()
+
+def run_helper (helpername, *args):
+	log_debug ('HELPER>', helpername, ' '.join (args))
+	try:
+		with helper_lock:
+			exitval = my_helper (helpername).main (list (args))
+	except SystemExit, se:
+		exitval = se.code
+	except Exception, e:
+		log_error ('Helper', helpername, 'failed:', e)
+		exitval = 1
+	if exitval is None:
+		exitval = 0
+	elif type (exitval) != int:
+		exitval = 1
+	return exitval
+
+class Debouncer (object):
+
+	"""Debouncer collects keys, such as zone names, and hands them
+	   to action (keys) in a background thread.  Keys are gathered
+	   for window seconds after the first one arrives, or until
+	   there are max_batch of them, and each key is passed once
+	   per batch, in order of arrival.  This allows consumers to
+	   return to their queue right after add(), while bursts of
+	   triggers for the same zone lead to one run of the action:
+
+		signconf = Debouncer (lambda zones: run_helper (
+				'ods-zonedata-signconf', *zones))
+		...
+		signconf.add (zone)
+
+	   When the action raises an exception, its keys are put back
+	   in front of the pending ones, and tried again after retry
+	   seconds.  Keys that are still pending at exit are handed
+	   to the action before the program ends.  This relies on
+	   atexit, so a program that may be stopped with SIGTERM
+	   should end its main loop on that, as my_signconf_debouncer()
+	   helps to do.
+	"""
+
+	def __init__ (self, action, window=1.0, max_batch=1000, retry=10.0):
+		self.action = action
+		self.window = window
+		self.max_batch = max_batch
+		self.retry = retry
+		self.pending = [ ]
+		self.due = None
+		self.busy = False
+		self.closing = False
+		self.cond = threading.Condition ()
+		self.thread = threading.Thread (target=self.run, name='Debouncer')
+		self.thread.daemon = True
+		self.thread.start ()
+		atexit.register (self.close)
+
+	def add (self, *keys):
+		"""Add keys to the pending batch, ignoring the ones that
+		   are already pending.
+		"""
+		with self.cond:
+			for key in keys:
+				if key not in self.pending:
+					self.pending.append (key)
+			if self.due is None and len (self.pending) > 0:
+				self.due = time.time () + self.window
+			self.cond.notify_all ()
+
+	def run (self):
+		while True:
+			with self.cond:
+				while len (self.pending) == 0 and not self.closing:
+					self.cond.wait (60)
+				if len (self.pending) == 0:
+					return
+				while not self.closing and len (self.pending) < self.max_batch:
+					remaining = self.due - time.time ()
+					if remaining <= 0:
+						break
+					self.cond.wait (remaining)
+				batch = self.pending [:self.max_batch]
+				self.pending = self.pending [self.max_batch:]
+				self.due = time.time () + self.window if len (self.pending) > 0 else None
+				self.busy = True
+			failed = False
+			try:
+				log_debug ('Debouncer runs for', len (batch), 'keys')
+				self.action (batch)
+			except Exception, e:
+				log_error ('Debouncer action failed:', e)
+				failed = True
+			with self.cond:
+				if failed and self.closing:
+					log_error ('Debouncer gives up on', ' '.join (map (str, batch)))
+				elif failed:
+					self.pending = batch + [ key for key in self.pending
+							if key not in batch ]
+					retry_at = time.time () + self.retry
+					while not self.closing and time.time () < retry_at:
+						self.cond.wait (retry_at - time.time ())
+					self.due = min (self.due or retry_at, retry_at)
+				self.busy = False
+				self.cond.notify_all ()
+
+	def flush (self):
+		"""Wait until the pending keys have been handed to the
+		   action, and the action is done.
+		"""
+		with self.cond:
+			while len (self.pending) > 0 or self.busy:
+				self.cond.wait (1)
+
+	def close (self):
+		"""Hand the pending keys to the action and stop the thread.
+		"""
+		with self.cond:
+			self.closing = True
+			self.cond.notify_all ()
+		self.thread.join ()
+
+# Return a Debouncer that runs ods-zonedata-signconf for batches of
+# zones, gathered for [opendnssec] signconf_window seconds.  The zones
+# may have been acknowledged already, so they should be handed to the
+# helper before the program ends.  A SIGTERM, as sent when the service
+# is stopped, only sets the terminating flag; the consumer loops of
+# ConnectionManager and MessageBatcher return when they see it, so the
+# main program can end normally, after close_signconf_debouncer().
+#
+def my_signconf_debouncer ():
+	global signconf_debouncer
+	if signconf_debouncer is None:
+		window = appcfg.getfloat ('opendnssec', 'signconf_window', fallback=1.0)
+		signconf_debouncer = Debouncer (_run_signconf, window=window)
+		signal.signal (signal.SIGTERM, _signconf_sigterm)
+	return signconf_debouncer
+
+def _signconf_sigterm (signum, frame):
+	global terminating
+	terminating = True
+
+def close_signconf_debouncer ():
+	if signconf_debouncer is not None:
+		log_info ('Generating pending .signconf files before termination')
+		signconf_debouncer.close ()
+
+def _run_signconf (zones):
+	with MetricTimer ('stage_seconds', stage='signconf'):
+		exitval = run_helper ('ods-zonedata-signconf', *zones)
+	if exitval != 0:
+		raise Exception ('ods-zonedata-signconf exited with ' + str (exitval))
+
+signconf_debouncer = None
+
+# Set when the program was asked to terminate, see my_signconf_debouncer()
+#
+terminating = False
+
 # Retrieve a PlainCredentials object based on the current appname.
 # Overrides exist for appname and username.
 #
@@ -190,6 +554,7 @@ def my_credentials (ovr_appname=None, ovr_username=None):
 # my_credentials().
 # 
 def my_connectionparameters (my_creds, host=this_machine, port=this_port, **params):
+	params.setdefault ('heartbeat', heartbeat)
 	return pika.ConnectionParameters (
 			host,
 			port,
@@ -199,6 +564,13 @@ def my_connectionparameters (my_creds, host=this_machine, port=this_port, **para
 			credentials=my_creds,
 			**params)
 
+# Retrieve the shared ConnectionManager for the current appname.
+# Overrides exist for appname and username, as for my_credentials().
+#
+def my_connection (ovr_appname=None, ovr_username=None, host=this_machine):
+	creds = my_credentials (ovr_appname=ovr_appname, ovr_username=ovr_username)
+	return shared_connection (creds.username, host=host)
+
 # Construct a BasicProperties object, based on standard available
 # information and optional headers.  There are options for overriding
 # the username.
@@ -221,6 +593,731 @@ def pkcs11_pinfile ():
 	"""
 	return pkcs11_pinfile_path
 
+pkcs11_lib = None
+
+def pkcs11_library ():
+	"""Return the PKCS #11 library, loaded only once per process
+	   because it cannot be initialised twice, as would happen
+	   when helper programs run in-process.
+	"""
+	global pkcs11_lib
+	if pkcs11_lib is None:
+		import PyKCS11
+		pkcs11_lib = PyKCS11.PyKCS11Lib ()
+		pkcs11_lib.load (pkcs11_libfile)
+		log_info ('Loaded PKCS #11 library', pkcs11_libfile)
+	return pkcs11_lib
+
+# Zone keys in PKCS #11 are ECDSA key pairs with the zone name in the
+# CKA_LABEL and a BCD-annotated timestamp with random bytes in CKA_ID.
+#
+oidP256 = ''.join ([ chr(c) for c in [ 0x06, 0x08, 0x2a, 0x86, 0x48, 0xce, 0x3d, 0x03, 0x01, 0x07 ] ])
+oidP384 = ''.join ([ chr(c) for c in [ 0x06, 0x05, 0x2b, 0x81, 0x04, 0x00, 0x22 ] ])
+# Map curve names to (algid, ecparams)
+pkcs11_curves = {
+	"P-256": (13, oidP256),
+	"P-384": (14, oidP384),
+}
+
+# The key index is reloaded from the token after index_ttl seconds.
+# A zone without keys is looked up again after index_miss_ttl seconds,
+# so keys that arrive through HSM replication are picked up.
+#
+pkcs11_index_ttl      = float (appcfg ['pkcs11'].get ('index_ttl',      '300'))
+pkcs11_index_miss_ttl = float (appcfg ['pkcs11'].get ('index_miss_ttl', '10'))
+
+# Construct the BCD representation of intval in bcdcount digits
+#
+def int2bcd (intval, bcdcount):
+	retval = ''
+	while bcdcount > 0:
+		decval = intval % 100
+		intval = intval / 100
+		hexval = (decval / 10) * 16 + (decval % 10)
+		retval = chr (hexval) + retval
+		bcdcount = bcdcount - 2
+	assert (bcdcount == 0)
+	assert (intval == 0)
+	return retval
+
+# Construct a new CKA_ID, a BCD format YYYYMMDDhhmmssuuuuuu followed
+# by 10 random bytes to spread it out
+#
+def pkcs11_new_cka_id ():
+	now = time.time ()
+	now_int = int (now)
+	now_us = int (1000000 * (now - now_int))
+	(now_year, now_month, now_day, now_hour, now_min, now_sec) = time.localtime (now_int) [:6]
+	now_bcd = int2bcd (now_year, 4) + int2bcd (now_month, 2) + int2bcd (now_day, 2) + int2bcd (now_hour, 2) + int2bcd (now_min, 2) + int2bcd (now_sec, 2) + int2bcd (now_us, 6)
+	prng = random.Random ()
+	xtid = ''.join ([ chr (int (prng.uniform (0, 256))) for i in range(10) ])
+	return now_bcd + xtid
+
+class PKCS11Token (object):
+
+	"""PKCS11Token holds a logged-in session on a PKCS #11 token
+	   for as long as the process runs, so the library, slot and
+	   login need not be setup for every zone.  A session that is
+	   lost, for instance to a restart of a network HSM, is opened
+	   again and the operation is retried once.
+
+	   The token keeps an index from CKA_LABEL, so the zone name,
+	   to the CKA_ID values of its key pairs on the configured
+	   curve.  The index is updated when keys are generated or
+	   destroyed through this object, and it is reloaded from the
+	   token as described for pkcs11_index_ttl.  Zones that are
+	   not in a fresh index have no keys.  When another process
+	   or machine may have changed the keys of a zone, invalidate()
+	   it to look it up on the token again.
+
+	   Use my_pkcs11_token() to share one instance per token.
+	"""
+
+	def __init__ (self, tokenlabel=pkcs11_token_label, curve_name=pkcs11_curve_name):
+		if curve_name not in pkcs11_curves.keys ():
+			raise NotImplementedError ('Acceptable curve names are: ' + ', '.join (pkcs11_curves.keys ()))
+		self.tokenlabel = tokenlabel
+		(self.dns_algid,self.ecparams) = pkcs11_curves [curve_name]
+		self.session = None
+		self.index = { }
+		self.index_time = 0
+		self.missed = { }
+		self.stale = set ()
+
+	def open_session (self):
+		"""Find the slot with our token, open a session and login.
+		"""
+		import PyKCS11
+		p11lib = pkcs11_library ()
+		paddedlabel = (self.tokenlabel + ' ' * 32) [:32]
+		slot_found = None
+		for slotid in p11lib.getSlotList ():
+			tokeninfo = p11lib.getTokenInfo (slotid)
+			if tokeninfo is None:
+				continue
+			if tokeninfo.label == paddedlabel:
+				slot_found = slotid
+		if slot_found is None:
+			raise Exception ('Failed to locate a token with label ' + self.tokenlabel)
+		session = p11lib.openSession (slot_found, PyKCS11.CKF_RW_SESSION)
+		session.login (pkcs11_pin (), PyKCS11.CKU_USER)
+		log_info ('Logged into PKCS #11 token', self.tokenlabel)
+		return session
+
+	def call (self, operation):
+		"""Run operation (session) on the logged-in session and
+		   return its result.  Reopen the session when it was lost.
+		"""
+		import PyKCS11
+		lost = [ getattr (PyKCS11, ckr) for ckr in [
+				'CKR_SESSION_HANDLE_INVALID', 'CKR_SESSION_CLOSED',
+				'CKR_USER_NOT_LOGGED_IN', 'CKR_DEVICE_REMOVED',
+				'CKR_DEVICE_ERROR', 'CKR_TOKEN_NOT_PRESENT' ]
+			if hasattr (PyKCS11, ckr) ]
+		retry = True
+		while True:
+			if self.session is None:
+				self.session = self.open_session ()
+			try:
+				return operation (self.session)
+			except PyKCS11.PyKCS11Error, e:
+				if not retry or e.value not in lost:
+					raise
+				log_warning ('Reopening PKCS #11 session after', e)
+				self.session = None
+				retry = False
+
+	def public_template (self, zone, cka_id=None):
+		import PyKCS11
+		tmpl = [
+			( PyKCS11.CKA_CLASS,		PyKCS11.CKO_PUBLIC_KEY ),
+			( PyKCS11.CKA_EC_PARAMS,	self.ecparams ),
+			( PyKCS11.CKA_KEY_TYPE,		PyKCS11.CKK_ECDSA ),
+			( PyKCS11.CKA_VERIFY,		True ),
+			( PyKCS11.CKA_ENCRYPT,		False ),
+			( PyKCS11.CKA_WRAP,		False ),
+			( PyKCS11.CKA_TOKEN,		True ),
+		]
+		if zone is not None:
+			tmpl.append ( ( PyKCS11.CKA_LABEL,	zone ) )
+		if cka_id is not None:
+			tmpl.append ( ( PyKCS11.CKA_ID,		cka_id ) )
+		return tmpl
+
+	def private_template (self, zone, cka_id=None):
+		import PyKCS11
+		tmpl = [
+			( PyKCS11.CKA_CLASS,		PyKCS11.CKO_PRIVATE_KEY ),
+			( PyKCS11.CKA_LABEL,		zone ),
+			( PyKCS11.CKA_KEY_TYPE,		PyKCS11.CKK_ECDSA ),
+			( PyKCS11.CKA_SIGN,		True ),
+			( PyKCS11.CKA_DECRYPT,		False ),
+			( PyKCS11.CKA_UNWRAP,		False ),
+			( PyKCS11.CKA_SENSITIVE,	True ),
+			( PyKCS11.CKA_TOKEN,		True ),
+			( PyKCS11.CKA_PRIVATE,		True ),
+			( PyKCS11.CKA_EXTRACTABLE,	False ),
+		]
+		if cka_id is not None:
+			tmpl.append ( ( PyKCS11.CKA_ID,		cka_id ) )
+		return tmpl
+
+	def refresh (self):
+		"""Reload the index of zone names to CKA_ID values.
+		"""
+		import PyKCS11
+		tmpl = self.public_template (None)
+		def load (session):
+			return [ session.getAttributeValue (obj, [PyKCS11.CKA_LABEL, PyKCS11.CKA_ID])
+				for obj in session.findObjects (tmpl) ]
+		index = { }
+		for (label,cka_id) in self.call (load):
+			cka_id = ''.join (map (chr, cka_id))
+			index.setdefault (label, []).append (cka_id)
+		for cka_ids in index.values ():
+			cka_ids.sort ()
+		self.index = index
+		self.index_time = time.time ()
+		self.missed = { }
+		self.stale = set ()
+		log_debug ('Indexed PKCS #11 keys for', len (index), 'zones')
+
+	def lookup (self, zone):
+		"""Reload the CKA_ID values for just one zone, and return
+		   them as binary strings.  Use this rather than key_ids()
+		   when the result is written out and must be current.
+		"""
+		import PyKCS11
+		tmpl = self.public_template (zone)
+		def load (session):
+			return [ session.getAttributeValue (obj, [PyKCS11.CKA_ID]) [0]
+				for obj in session.findObjects (tmpl) ]
+		cka_ids = [ ''.join (map (chr, cka_id)) for cka_id in self.call (load) ]
+		cka_ids.sort ()
+		self.index [zone] = cka_ids
+		self.stale.discard (zone)
+		if len (cka_ids) == 0:
+			self.missed [zone] = time.time ()
+		return list (cka_ids)
+
+	def invalidate (self, zone):
+		"""Forget the keys of a zone until it is looked up again.
+		"""
+		if self.index.has_key (zone):
+			del self.index [zone]
+		self.stale.add (zone)
+
+	def key_ids (self, zone):
+		"""Return the CKA_ID values of the key pairs for a zone,
+		   as binary strings.  These may be up to index_ttl seconds
+		   old, since other processes may have changed the keys;
+		   only use this where such stale data is harmless.
+		"""
+		now = time.time ()
+		if now - self.index_time > pkcs11_index_ttl:
+			self.refresh ()
+		if zone in self.stale:
+			self.lookup (zone)
+		elif not self.index.has_key (zone):
+			if now - self.index_time > pkcs11_index_miss_ttl:
+				self.lookup (zone)
+			else:
+				return [ ]
+		elif self.missed.has_key (zone) and now - self.missed [zone] > pkcs11_index_miss_ttl:
+			self.lookup (zone)
+		return list (self.index [zone])
+
+	def generate_keypair (self, zone):
+		"""Generate a key pair for the zone and return its CKA_ID.
+		"""
+		import PyKCS11
+		cka_id = pkcs11_new_cka_id ()
+		log_debug ('CKA_ID starting with BCD value is', cka_id.encode ('hex'))
+		ckm_ecdsa = PyKCS11.Mechanism (PyKCS11.CKM_ECDSA_KEY_PAIR_GEN, None)
+		pubtmpl  = self.public_template  (zone, cka_id)
+		privtmpl = self.private_template (zone, cka_id)
+		self.call (lambda session: session.generateKeyPair (pubtmpl, privtmpl, ckm_ecdsa))
+		if self.index.has_key (zone):
+			self.index [zone].append (cka_id)
+			self.index [zone].sort ()
+			self.missed.pop (zone, None)
+		else:
+			self.stale.add (zone)
+		return cka_id
+
+	def destroy_keys (self, zone):
+		"""Destroy the public and private keys of the zone and
+		   return how many objects were destroyed.
+		"""
+		destroyed = 0
+		for (kind,tmpl) in [ ('public',  self.public_template  (zone)),
+		                     ('private', self.private_template (zone)) ]:
+			keys = self.call (lambda session: session.findObjects (tmpl))
+			log_debug ('Found', len (keys), kind, 'keys for', zone)
+			for key in keys:
+				self.call (lambda session: session.destroyObject (key))
+				destroyed += 1
+		self.index [zone] = [ ]
+		self.missed [zone] = time.time ()
+		return destroyed
+
+	def close (self):
+		if self.session is not None:
+			try:
+				self.session.logout ()
+				self.session.closeSession ()
+			except Exception, e:
+				log_debug ('Ignoring error while closing PKCS #11 session:', e)
+			self.session = None
+
+# Tokens with their logged-in sessions, indexed by token label
+#
+pkcs11_tokens = { }
+
+# Return the shared PKCS11Token for the configured token label.
+#
+def my_pkcs11_token (tokenlabel=None):
+	tokenlabel = tokenlabel or pkcs11_token_label
+	if not pkcs11_tokens.has_key (tokenlabel):
+		pkcs11_tokens [tokenlabel] = PKCS11Token (tokenlabel)
+	return pkcs11_tokens [tokenlabel]
+
+def cleanup_pkcs11 ():
+	for token in pkcs11_tokens.values ():
+		token.close ()
+
+atexit.register (cleanup_pkcs11)
+
+class ZonedataIndex (object):
+
+	"""ZonedataIndex is a persistent sqlite index of the zone files
+	   in /var/opendnssec/uploaded.  For every zone, it holds the
+	   SOA serial, the SHA-256 of the file contents and the
+	   file_stamp() of the file, so its mtime, size and inode.
+	   This allows decisions about new zone data without parsing
+	   the old zone file.
+
+	   The index is only trusted while the stamp matches the file.
+	   Changes are made in a transaction that is committed right
+	   after the zone file is renamed into place, which keeps its
+	   mtime and inode, so a crash leaves at most one stale entry,
+	   which the stamp reveals, as it does changes made elsewhere:
+
+		idx.store (zone, serial, digest, file_stamp (newfile))
+		os.rename (newfile, txtfile)
+		idx.commit ()
+
+	   Rebuild the index with ods-zonedata-reindex.
+	"""
+
+	def __init__ (self, path):
+		self.path = path
+		self.db = sqlite3.connect (path)
+		self.db.execute ('CREATE TABLE IF NOT EXISTS zonedata (zone TEXT PRIMARY KEY, serial INTEGER, sha256 TEXT, size INTEGER, mtime REAL, inode INTEGER)')
+		# Older indexes lack the mtime and inode, so their entries never match
+		columns = [ row [1] for row in self.db.execute ('PRAGMA table_info (zonedata)') ]
+		for (column,coltype) in [ ('mtime', 'REAL'), ('inode', 'INTEGER') ]:
+			if column not in columns:
+				self.db.execute ('ALTER TABLE zonedata ADD COLUMN ' + column + ' ' + coltype)
+		self.db.commit ()
+
+	def lookup (self, zone):
+		"""Return (serial,sha256,stamp) for the zone, or None.
+		   The stamp is (mtime,size,inode) as from file_stamp().
+		"""
+		row = self.db.execute ('SELECT serial, sha256, mtime, size, inode FROM zonedata WHERE zone=?', (zone,)).fetchone ()
+		if row is None:
+			return None
+		return (row [0], row [1], tuple (row [2:]))
+
+	def store (self, zone, serial, sha256, stamp):
+		(mtime,size,inode) = stamp
+		self.db.execute ('INSERT OR REPLACE INTO zonedata (zone, serial, sha256, size, mtime, inode) VALUES (?,?,?,?,?,?)', (zone, serial, sha256, size, mtime, inode))
+
+	def remove (self, zone):
+		self.db.execute ('DELETE FROM zonedata WHERE zone=?', (zone,))
+
+	def clear (self):
+		self.db.execute ('DELETE FROM zonedata')
+
+	def commit (self):
+		self.db.commit ()
+
+	def rollback (self):
+		self.db.rollback ()
+
+	def close (self):
+		self.db.close ()
+
+# Return the hex SHA-256 digest of zone file text, as in ZonedataIndex.
+#
+def zonedata_digest (text):
+	if type (text) == unicode:
+		text = text.encode ('utf-8')
+	return hashlib.sha256 (text).hexdigest ()
+
+# Open the ZonedataIndex configured for ods-zonedata-recv.
+#
+def my_zonedata_index ():
+	path = appcfg ['ods-zonedata-recv'].get ('upload_index', '/var/opendnssec/uploaded/.index.sqlite')
+	return ZonedataIndex (path)
+
+# Return a stamp for a file that changes when the file is replaced or
+# modified, for use in caches of data derived from the file.
+#
+def file_stamp (path):
+	st = os.stat (path)
+	return (st.st_mtime, st.st_size, st.st_ino)
+
+# Map the path of a zonelist.xml to (stamp,names) for zonelist_names()
+#
+zonelist_cache = { }
+
+# Return the zone names in an OpenDNSSEC zonelist.xml as a frozenset.
+# The file is only parsed again when its file_stamp() has changed,
+# so this is cheap to call for every zone that needs checking.
+#
+def zonelist_names (path):
+	stamp = file_stamp (path)
+	cached = zonelist_cache.get (path)
+	if cached is not None and cached [0] == stamp:
+		return cached [1]
+	names = set ()
+	for (event,elem) in ElementTree.iterparse (path):
+		if elem.tag == 'Zone':
+			if elem.get ('name') is not None:
+				names.add (elem.get ('name'))
+			elem.clear ()
+	names = frozenset (names)
+	zonelist_cache [path] = (stamp, names)
+	return names
+
+# Zonedata messages may be compressed, which is announced with a
+# content-encoding header next to the subject.  The only encoding is
+# zlib; without the header, the body is plain zone file text.
+#
+zonedata_encodings = ['zlib']
+
+# Compress zonedata of at least threshold bytes, and return the
+# message body with its encoding, or with None when not compressed.
+# A threshold of 0 disables compression.
+#
+def zonedata_compress (zonedata, threshold):
+	if threshold <= 0 or len (zonedata) < threshold:
+		return (zonedata, None)
+	return (zlib.compress (zonedata), 'zlib')
+
+# Return the first part of the decompressed zonedata in a message body,
+# up to about size bytes, without decompressing the remainder.
+#
+def zonedata_head (body, encoding, size=65536):
+	if encoding is None:
+		return body [:size]
+	if encoding not in zonedata_encodings:
+		raise Exception ('Unsupported content-encoding ' + str (encoding))
+	return zlib.decompressobj ().decompress (body, size)
+
+# Decompress the zonedata in a message body and write it to outfile,
+# one chunk at a time.  Return the number of bytes written.
+#
+def zonedata_inflate (body, encoding, outfile, chunk=1048576):
+	if encoding is None:
+		outfile.write (body)
+		return len (body)
+	if encoding not in zonedata_encodings:
+		raise Exception ('Unsupported content-encoding ' + str (encoding))
+	dec = zlib.decompressobj ()
+	size = 0
+	while body != '':
+		data = dec.decompress (body, chunk)
+		outfile.write (data)
+		size += len (data)
+		body = dec.unconsumed_tail
+	data = dec.flush ()
+	outfile.write (data)
+	size += len (data)
+	return size
+
+# Return the text line for a record in zonedata, with absolute names,
+# as written by ods-zonedata-recv and as digested by ZoneRecordsDigest.
+#
+def zonedata_record_line (name, ttl, rdtype, rdata):
+	return '%s %d IN %s %s\n' % (name.to_text (), ttl,
+		dns.rdatatype.to_text (rdtype),
+		rdata.to_text (origin=None, relativize=False))
+
+class ZoneRecordsDigest (object):
+
+	"""ZoneRecordsDigest digests the records of a zone without
+	   regard for their order, so the sender of a delta and the
+	   receiver that applies it can compare the resulting zones
+	   while they hold the records in different orders.  It adds
+	   up the SHA-256 of every zonedata_record_line() modulo 2^256,
+	   so it needs no memory for the records:
+
+		zrd = ZoneRecordsDigest ()
+		for (name,ttl,rdata) in ...:
+			zrd.update (zonedata_record_line (name, ttl, rdata.rdtype, rdata))
+		zrd.hexdigest ()
+	"""
+
+	def __init__ (self):
+		self.total = 0
+
+	def update (self, line):
+		self.total = (self.total + int (hashlib.sha256 (line).hexdigest (), 16)) % (1 << 256)
+
+	def hexdigest (self):
+		return '%064x' % self.total
+
+class DSCache (object):
+
+	"""DSCache memoises the DS records and key tags derived from
+	   DNSKEY records, which are computed over and again for the
+	   same keys while parenting.  Entries are found by the owner
+	   name, the DNSKEY in wire format and the digest type, and the
+	   least recently used entries are dropped when more than size
+	   entries would be held.  The methods may be called from more
+	   than one thread.
+	"""
+
+	def __init__ (self, size=10000):
+		self.size = size
+		self.entries = collections.OrderedDict ()
+		self.lock = threading.Lock ()
+
+	def _find (self, cachekey, compute):
+		with self.lock:
+			value = self.entries.pop (cachekey, None)
+			if value is not None:
+				self.entries [cachekey] = value
+				return value
+		value = compute ()
+		with self.lock:
+			self.entries [cachekey] = value
+			while len (self.entries) > self.size:
+				self.entries.popitem (last=False)
+		return value
+
+	def make_ds (self, owner, key, algorithm):
+		"""Return the DS for the DNSKEY, as dns.dnssec.make_ds()
+		   would, with the algorithm given by name.
+		"""
+		if not isinstance (owner, dns.name.Name):
+			owner = dns.name.from_text (owner)
+		cachekey = ('DS', owner.canonicalize (), key.to_digestable (), algorithm.upper ())
+		return self._find (cachekey,
+			lambda: dns.dnssec.make_ds (owner, key, algorithm))
+
+	def key_tag (self, key):
+		"""Return the key tag of the DNSKEY.
+		"""
+		cachekey = ('tag', key.to_digestable ())
+		return self._find (cachekey,
+			lambda: dns.dnssec.key_id (key))
+
+# The DSCache shared by all users in a process, holding up to
+# [rabbitmq] ds_cache_size entries.
+#
+ds_cache = DSCache (int (appcfg ['rabbitmq'].get ('ds_cache_size', '10000')))
+
+# Messages on the parenting exchange hold an RRset for the routing key.
+# They are in text form, as lines like "3600 IN DNSKEY 257 3 13 ...", or
+# in DNS wire form, as announced with a content-type header holding
+# parenting_wire_type.  Receivers accept both; senders use the form set
+# as message_format in [ods-parenting].  An empty body is sent as is.
+#
+parenting_wire_type = 'application/x-dns-rrset'
+parenting_format = appcfg.get ('ods-parenting', 'message_format', fallback='text')
+
+# Return the DNS wire form of an RRset, as sent on the parenting exchange.
+#
+def rrset_wire (owner, ttl, rdatas):
+	if not isinstance (owner, dns.name.Name):
+		owner = dns.name.from_text (owner)
+	wire = cStringIO.StringIO ()
+	dns.rrset.from_rdata_list (owner, ttl, rdatas).to_wire (wire, want_shuffle=False)
+	return wire.getvalue ()
+
+# Parse the DNS wire form of an RRset, as produced by rrset_wire(), and
+# return (owner,ttl,rdclass,rdtype,[rdata,...]).
+#
+def rrset_unwire (wire):
+	owner = None
+	prev = None
+	rdatas = []
+	current = 0
+	while current < len (wire):
+		(name,used) = dns.name.from_wire (wire, current)
+		current += used
+		(rdtype,rdclass,ttl,rdlen) = struct.unpack ('!HHIH', wire [current:current+10])
+		current += 10
+		if prev is not None and prev != (name,rdtype,rdclass,ttl):
+			raise Exception ('Records in wire RRset differ in owner, type, class or TTL')
+		prev = (name,rdtype,rdclass,ttl)
+		rdatas.append (dns.rdata.from_wire (rdclass, rdtype, wire, current, rdlen))
+		current += rdlen
+	if prev is None:
+		raise Exception ('Empty wire RRset')
+	(owner,rdtype,rdclass,ttl) = prev
+	return (owner,ttl,rdclass,rdtype,rdatas)
+
+# Return the properties for a message on the parenting exchange, which
+# announce the wire form when wire is set.
+#
+def parenting_properties (wire, ovr_username='parenting'):
+	if not wire:
+		return None
+	return my_basicproperties (headers={ 'content-type': parenting_wire_type },
+			ovr_username=ovr_username)
+
+# Return whether a message on the parenting exchange is in wire form.
+#
+def parenting_is_wire (props):
+	return props is not None and props.headers is not None and props.headers.get ('content-type') == parenting_wire_type
+
+# Return the set of zone names configured in Knot DNS, as listed by
+# "knotc conf-read zone.domain".
+#
+def knot_zone_names ():
+	#
+	# Run knotc to retrieve zone names
+	zlist = os.popen ('/usr/sbin/knotc conf-read zone.domain', 'r')
+	#
+	# Collect the zone names mentioned in the zone list
+	workset = set ()
+	for zln in zlist:
+		zln = zln.rstrip ()
+		if zln == 'OK':
+			# Overcome inconsistent reporting habits of Knot DNS
+			continue
+		if zln [:14] != 'zone.domain = ':
+			raise Exception ('Found something else than a zone.domain property after "knotc conf-read zone.domain"')
+		work = zln [14:]
+		if work [-1:] == '.':
+			work = work [:-1]
+		workset.add (work)
+	if zlist.close () is not None:
+		raise Exception ('Knot DNS not available for registry zone listing')
+	return workset
+
+class KnotZoneInventory (object):
+
+	"""KnotZoneInventory keeps the names of the zones that Knot DNS
+	   serves, so that checking whether a zone exists need not
+	   involve knotc.  The names are persisted in a file with one
+	   name per line, which is shared between processes:
+
+	    - ods-zonedata-recv updates it after adding or removing zones
+	    - other processes read it again when its file_stamp() changes
+	    - every reconcile_interval seconds, a process replaces it
+	      with the outcome of knot_zone_names()
+
+	   Changes to the file are made under an fcntl lock on the file
+	   with .lock appended, and installed with an atomic rename.
+	   The inventory starts from knot_zone_names() when the file
+	   does not exist yet.
+	"""
+
+	def __init__ (self, path, reconcile_interval=3600):
+		self.path = path
+		self.reconcile_interval = reconcile_interval
+		self.stamp = None
+		self.zones = frozenset ()
+		self.reconciled = None
+
+	def _lock (self):
+		lockfile = open (self.path + '.lock', 'a')
+		fcntl.lockf (lockfile, fcntl.LOCK_EX)
+		return lockfile
+
+	def _read (self):
+		stamp = file_stamp (self.path)
+		if stamp != self.stamp:
+			self.zones = frozenset ([ zln.strip () for zln in open (self.path) if zln.strip () != '' ])
+			self.stamp = stamp
+
+	def _write (self, zones):
+		newpath = self.path + '.new.%d' % os.getpid ()
+		fd = open (newpath, 'w')
+		fd.write (''.join ([ z + '\n' for z in sorted (zones) ]))
+		fd.close ()
+		os.chmod (newpath, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP)
+		os.rename (newpath, self.path)
+		self.zones = frozenset (zones)
+		self.stamp = file_stamp (self.path)
+
+	def reconcile (self):
+		"""Replace the inventory with the zones that Knot DNS
+		   currently has configured.
+		"""
+		lockfile = self._lock ()
+		try:
+			self._write (knot_zone_names ())
+		finally:
+			lockfile.close ()
+		self.reconciled = time.time ()
+		log_debug ('Reconciled', len (self.zones), 'zones in', self.path, 'with Knot DNS')
+
+	def refresh (self):
+		"""Load the inventory when it changed, or reconcile it
+		   when that is due.  Once loaded, a failure to reconcile
+		   is logged and the current inventory is kept.
+		"""
+		now = time.time ()
+		if self.reconciled is None:
+			if os.path.exists (self.path):
+				self._read ()
+				self.reconciled = now
+			else:
+				self.reconcile ()
+		elif now - self.reconciled >= self.reconcile_interval:
+			try:
+				self.reconcile ()
+			except Exception, e:
+				log_error ('Failed to reconcile', self.path, 'with Knot DNS:', e)
+				self.reconciled = now
+		else:
+			self._read ()
+
+	def names (self):
+		"""Return the zone names as a frozenset.
+		"""
+		self.refresh ()
+		return self.zones
+
+	def exists (self, zone):
+		return zone in self.names ()
+
+	def update (self, added=[], removed=[]):
+		"""Add and remove zones after Knot DNS has committed these
+		   changes to its configuration.
+		"""
+		lockfile = self._lock ()
+		try:
+			if os.path.exists (self.path):
+				self._read ()
+				zones = (set (self.zones) | set (added)) - set (removed)
+			else:
+				zones = knot_zone_names ()
+				self.reconciled = time.time ()
+			self._write (zones)
+		finally:
+			lockfile.close ()
+
+# Return the KnotZoneInventory configured in [knot] as zone_inventory,
+# reconciled every inventory_reconcile seconds.
+#
+def my_knot_zone_inventory ():
+	global knot_zone_inventory
+	if knot_zone_inventory is None:
+		path = appcfg ['knot'].get ('zone_inventory', '/var/opendnssec/signed/.knot-zones')
+		interval = appcfg.getfloat ('knot', 'inventory_reconcile', fallback=3600)
+		knot_zone_inventory = KnotZoneInventory (path, reconcile_interval=interval)
+	return knot_zone_inventory
+
+knot_zone_inventory = None
+
 class MessageCollector (object):
 
 	"""MessageCollector synchronously loads at least one message,
@@ -229,6 +1326,9 @@ class MessageCollector (object):
 	   operation is possible.  At the same time, it does not slow
 	   down operations when messages drip in one at a time.
 
+	   Note that this polls the queue; see MessageBatcher for a
+	   variety that has the messages pushed by the broker.
+
 	   This is probably best combined with transactions, as in
 
 		chan.tx_select ()
@@ -344,6 +1444,592 @@ class MessageCollector (object):
 		self.msglist.append (body)
 
 
+class MessageBatcher (object):
+
+	"""MessageBatcher is the push-based variety of MessageCollector.
+	   Instead of polling with basic_get, it registers a consumer
+	   on the queue and sets a prefetch window, so the broker can
+	   send messages ahead of our processing.  A call to collect()
+	   blocks until at least one message has arrived, and then
+	   continues until either max_batch messages are available or
+	   max_wait seconds have passed since the first message.
+
+	   The batch is acknowledged or rejected as a whole, with a
+	   single frame that sets multiple=True.  This is why the
+	   channel should not be shared with other consumers.  When
+	   only some messages failed, settle() rejects just those.
+
+	   The instance holds on to the consumer, so it should be
+	   created once and then collect() can be called in a loop:
+
+		chan.tx_select ()
+		clx = MessageBatcher (chan, queue=...)
+		while True:
+			clx.collect ()
+			for m in clx.messages ():
+				...inner.loop...
+			if ...we are happy...:
+				clx.ack ()
+			else:
+				clx.nack ()
+			chan.tx_commit ()
+	"""
+
+	def __init__ (self, chan, queue, max_batch=100, max_wait=2.0):
+		self.chan = chan
+		self.queue = queue
+		self.max_batch = max_batch
+		self.max_wait = max_wait
+		self.batch = []
+		self.first = None
+		self.chan.basic_qos (prefetch_count=max_batch)
+		self.consumer = self.chan.basic_consume (self.deliver,
+					queue=queue)
+
+	def deliver (self, chan, mth, props, body):
+		"""Take note of a delivered message, and of the time
+		   at which the first message of a batch arrived.
+		"""
+		if len (self.batch) == 0:
+			self.first = time.time ()
+		self.batch.append ( (mth,props,body) )
+
+	def messages (self):
+		"""Return the list of message bodies collected.
+		"""
+		return [ body for (mth,props,body) in self.batch ]
+
+	def deliveries (self):
+		"""Return the list of (method,properties,body) collected.
+		"""
+		return self.batch
+
+	def count (self):
+		"""Return the number of messages collected.
+		"""
+		return len (self.batch)
+
+	def ack (self):
+		"""Send one basic_ack() covering all collected messages.
+		"""
+		if len (self.batch) > 0:
+			lasttag = self.batch [-1] [0].delivery_tag
+			self.chan.basic_ack (delivery_tag=lasttag, multiple=True)
+		self.batch = []
+
+	def nack (self, requeue=True):
+		"""Send one basic_nack() covering all collected messages.
+		"""
+		if len (self.batch) > 0:
+			lasttag = self.batch [-1] [0].delivery_tag
+			self.chan.basic_nack (delivery_tag=lasttag, multiple=True,
+						requeue=requeue)
+		self.batch = []
+
+	def settle (self, failed, requeue=False):
+		"""Reject the messages whose delivery_tag is in failed,
+		   and acknowledge all others.  Runs of acceptable messages
+		   are acknowledged with one frame that sets multiple=True.
+		"""
+		pending = None
+		for (mth,props,body) in self.batch:
+			if mth.delivery_tag in failed:
+				if pending is not None:
+					self.chan.basic_ack (delivery_tag=pending, multiple=True)
+					pending = None
+				self.chan.basic_nack (delivery_tag=mth.delivery_tag,
+							requeue=requeue)
+			else:
+				pending = mth.delivery_tag
+		if pending is not None:
+			self.chan.basic_ack (delivery_tag=pending, multiple=True)
+		self.batch = []
+
+	def collect (self):
+		"""Collect at least one message, waiting as long as it
+		   takes.  After the first message has arrived, continue
+		   to collect until max_batch messages are available or
+		   until max_wait seconds have passed.  Any messages of
+		   a former batch must have been ack()ed or nack()ed.
+		   When the program is terminating, this returns without
+		   waiting for a first message, so count() may be 0.
+		"""
+		assert (len (self.batch) == 0)
+		cnx = self.chan.connection
+		while len (self.batch) == 0:
+			if terminating:
+				return
+			cnx.process_data_events (time_limit=1)
+		while len (self.batch) < self.max_batch:
+			remaining = self.first + self.max_wait - time.time ()
+			if remaining <= 0:
+				break
+			cnx.process_data_events (time_limit=remaining)
+
+	def cancel (self):
+		"""Stop consuming.  Messages that have not been ack()ed
+		   or nack()ed will be returned to the queue.
+		"""
+		self.nack (requeue=True)
+		self.chan.basic_cancel (self.consumer)
+
+
+class ConnectionManager (object):
+
+	"""ConnectionManager holds one long-lived connection for an
+	   account and hands out channels on it.  This avoids the
+	   TLS handshake for every piece of work.  When the connection
+	   breaks down, it is reopened on the next request for a
+	   channel, with exponential backoff between attempts.
+
+	   Obtain the shared instance for an account with
+	   shared_connection() or my_connection(), and use it as in
+
+		amqp = rabbitdnssec.my_connection ()
+		chan = amqp.channel ()
+		...
+		chan.close ()
+
+	   Daemons that consume can have their consumers setup
+	   again after a reconnect by running
+
+		def setup (chan):
+			chan.basic_consume (...)
+		amqp.consume (setup)
+
+	   Daemons with their own consumer loop, such as one with a
+	   MessageBatcher, can use amqp.run (loop) instead.  Daemons
+	   that publish many messages can use the ConfirmPublisher
+	   from amqp.publisher (), which runs on its own connection.
+	"""
+
+	def __init__ (self, username, host=this_machine):
+		self.username = username
+		self.host = host
+		self.cnx = None
+		self.pub = None
+		self.opened = 0
+		self.backoff = 1
+
+	def parameters (self):
+		"""Return the ConnectionParameters for this account.
+		"""
+		password = appcfg ['accounts'] [self.username]
+		creds = pika.PlainCredentials (self.username, password)
+		return my_connectionparameters (creds, host=self.host)
+
+	def drop (self):
+		"""Drop the current connection, if any, without delay.
+		"""
+		if self.cnx is not None:
+			try:
+				self.cnx.close ()
+			except:
+				pass
+		self.cnx = None
+		self.opened = 0
+
+	def failed (self, e):
+		"""Drop the current connection after a failure, and wait
+		   before a new connection may be attempted.  The delay
+		   doubles when connections keep failing quickly, up to
+		   reconnect_max seconds.
+		"""
+		if self.opened != 0 and time.time () - self.opened > reconnect_max:
+			# The connection was stable for a while; start over
+			self.backoff = 1
+		self.drop ()
+		log_warning ('AMQP connection to', self.host, 'as', self.username, 'failed:', e, '-- retrying in', self.backoff, 'seconds')
+		time.sleep (self.backoff)
+		self.backoff = min (self.backoff * 2, reconnect_max)
+
+	def connection (self):
+		"""Return the connection, opening it when needed.
+		"""
+		while self.cnx is None or not self.cnx.is_open:
+			try:
+				self.cnx = pika.BlockingConnection (self.parameters ())
+				self.opened = time.time ()
+			except pika.exceptions.AMQPConnectionError, e:
+				self.failed (e)
+		return self.cnx
+
+	def service (self):
+		"""Process pending events on an open connection, which
+		   includes sending and checking heartbeats.  Programs
+		   that hold a connection without consuming should do
+		   this while they are idle, for instance through
+		   idle_sleep() or idle_read(), or the broker drops the
+		   connection after two missed heartbeats.
+		"""
+		if self.pub is not None:
+			self.pub.service ()
+		if self.cnx is None:
+			return
+		try:
+			self.cnx.process_data_events ()
+		except pika.exceptions.AMQPConnectionError, e:
+			self.dropped (e)
+
+	def dropped (self, e):
+		"""Forget a connection that was dropped while it was idle.
+		   It is opened again on the next request for a channel,
+		   without counting this as a failure.
+		"""
+		log_info ('AMQP connection to', self.host, 'as', self.username, 'was dropped while idle:', e)
+		self.drop ()
+
+	def channel (self):
+		"""Return a new channel on the connection.  Pending
+		   events are processed first, to find out about a
+		   connection that was dropped while idle; it is then
+		   reopened right away.
+		"""
+		while True:
+			idle = self.cnx is not None and self.cnx.is_open
+			cnx = self.connection ()
+			try:
+				cnx.process_data_events ()
+			except pika.exceptions.AMQPConnectionError, e:
+				if idle:
+					self.dropped (e)
+				else:
+					self.failed (e)
+				continue
+			try:
+				return cnx.channel ()
+			except pika.exceptions.AMQPConnectionError, e:
+				self.failed (e)
+
+	def consume (self, setup):
+		"""Run a consumer loop.  A fresh channel is passed to
+		   setup(chan) which should register the consumers, after
+		   which this channel starts consuming.  When the connection
+		   is lost, it is reopened and setup() is called again.
+		   Channel errors are not recovered, but raised.  This
+		   returns when the program is terminating.
+		"""
+		def loop (chan):
+			setup (chan)
+			while not terminating:
+				chan.connection.process_data_events (time_limit=1)
+		self.run (loop)
+
+	def run (self, loop):
+		"""Run loop(chan) on a fresh channel.  When the connection
+		   is lost, it is reopened and loop() is called again on a
+		   new channel.  Channel errors are not recovered, but raised.
+		"""
+		while True:
+			chan = self.channel ()
+			try:
+				return loop (chan)
+			except pika.exceptions.AMQPConnectionError, e:
+				self.failed (e)
+
+	def publisher (self, window=1000):
+		"""Return the ConfirmPublisher for this account, which
+		   has a connection of its own.  It is created on first
+		   use, and later calls return the same instance.
+		"""
+		if self.pub is None:
+			self.pub = ConfirmPublisher (self.parameters, window=window)
+		return self.pub
+
+	def close (self):
+		"""Close the connection, if it is open.
+		"""
+		if self.pub is not None:
+			self.pub.close ()
+		if self.cnx is not None and self.cnx.is_open:
+			self.cnx.close ()
+		self.cnx = None
+
+
+# The ConnectionManager instances, indexed by (username,host)
+#
+connection_managers = { }
+
+def shared_connection (username, host=this_machine):
+	"""Return the ConnectionManager for the given username and
+	   host, creating it when needed.  Connections are closed
+	   when the program exits.
+	"""
+	key = (username, host)
+	if not connection_managers.has_key (key):
+		connection_managers [key] = ConnectionManager (username, host=host)
+	return connection_managers [key]
+
+def cleanup_connections ():
+	for mgr in connection_managers.values ():
+		try:
+			mgr.close ()
+		except:
+			pass
+
+atexit.register (cleanup_connections)
+
+# The time between services of idle connections, well within the
+# two heartbeats after which the broker drops a connection.
+#
+idle_interval = max (1.0, (heartbeat or 60) / 2.0)
+
+def service_connections ():
+	for mgr in connection_managers.values ():
+		mgr.service ()
+
+# Sleep for the given number of seconds, while the shared connections
+# are kept alive.  Use this instead of time.sleep() between passes.
+#
+def idle_sleep (seconds):
+	end = time.time () + seconds
+	while True:
+		service_connections ()
+		remaining = end - time.time ()
+		if remaining <= 0:
+			break
+		time.sleep (min (remaining, idle_interval))
+
+# Wait for a writer on the named pipe at the given path, and return
+# what it wrote when it closes the pipe, like open(path).read() but
+# with the shared connections kept alive while waiting.
+#
+def idle_read (path):
+	fd = os.open (path, os.O_RDONLY | os.O_NONBLOCK)
+	try:
+		data = ''
+		while True:
+			(rd,_,_) = select.select ([fd], [], [], idle_interval)
+			if fd in rd:
+				more = os.read (fd, 65536)
+				if more == '':
+					return data
+				data += more
+			else:
+				service_connections ()
+	finally:
+		os.close (fd)
+
+
+class ConfirmPublisher (object):
+
+	"""ConfirmPublisher publishes messages in confirm mode, which
+	   is much faster than committing a transaction per message.
+	   Up to window messages may be in flight; confirmations and
+	   returns from the broker are processed asynchronously while
+	   more messages are being published.  Each message carries a
+	   token of the caller's choosing, which is reported back if
+	   the message failed, because it was rejected by the broker,
+	   returned as unroutable (when published as mandatory) or
+	   lost with the connection.
+
+		pub = amqp.publisher (window=...)
+		for ...:
+			pub.publish (exchange, routing_key, body,
+					properties=props, token=...)
+		for token in pub.flush ():
+			...retry later...
+
+	   A BlockingChannel waits for each confirmation in turn, so
+	   this publisher runs its own asynchronous SelectConnection.
+	   It is opened on the first publish() and kept for later use,
+	   until close().  The parameters are a function that returns
+	   the ConnectionParameters, like ConnectionManager.parameters.
+	   The ConnectionManager that hands it out with publisher()
+	   keeps it alive while the program is idle, and closes it.
+
+	   Confirmations are matched to messages by delivery tag.
+	   Returned messages are matched by their message_id, so the
+	   messages without one are published with a copy of their
+	   properties, to which a unique message_id is added.
+	"""
+
+	def __init__ (self, parameters, window=1000):
+		self.parameters = parameters
+		self.window = window
+		self.cnx = None
+		self.ioloop = None
+		self.chan = None
+		self.ready = False
+		self.error = None
+		self.broken = None
+		self.until = None
+		self.seqno = 0
+		self.msgno = 0
+		self.msgbase = '%s.%d.%d.' % (this_machine, os.getpid (), int (time.time ()))
+		self.pending = collections.OrderedDict ()
+		self.msgids = { }
+		self.returned = set ()
+		self.failed = [ ]
+
+	def _run (self, until=None):
+		"""Run the I/O loop until until() holds, or the connection
+		   is lost.  Without until, only process the I/O that is
+		   ready, along with any timers that are due.
+		"""
+		if self.cnx is None:
+			return
+		if until is None:
+			self.cnx.add_timeout (0, self.ioloop.stop)
+			until = lambda: False
+		elif until ():
+			return
+		self.until = until
+		try:
+			self.ioloop.start ()
+		finally:
+			self.until = None
+
+	def _check (self):
+		if self.until is not None and self.until ():
+			self.ioloop.stop ()
+
+	def _open (self):
+		self.ready = False
+		self.seqno = 0
+		self.cnx = pika.SelectConnection (self.parameters (),
+				on_open_callback=self._on_open,
+				on_open_error_callback=self._on_open_error,
+				on_close_callback=self._on_close,
+				stop_ioloop_on_close=False)
+		self.ioloop = self.cnx.ioloop
+		self._run (lambda: self.ready)
+		if self.cnx is None:
+			self.broken = self.error
+			raise pika.exceptions.AMQPConnectionError (self.broken)
+
+	def _on_open (self, cnx):
+		cnx.channel (on_open_callback=self._on_channel)
+
+	def _on_channel (self, chan):
+		self.chan = chan
+		chan.add_on_close_callback (self._on_channel_close)
+		chan.add_on_return_callback (self._on_return)
+		chan.add_callback (self._on_selectok,
+				replies=[pika.spec.Confirm.SelectOk])
+		chan.confirm_delivery (callback=self._on_confirm)
+
+	def _on_selectok (self, frame):
+		self.ready = True
+		self._check ()
+
+	def _on_open_error (self, cnx, error):
+		self._lost (error)
+
+	def _on_close (self, cnx, code, text):
+		self._lost (text)
+
+	def _on_channel_close (self, chan, code, text):
+		# Confirmations are only valid on the channel that was
+		# selected for them, so start over with a new connection
+		log_error ('AMQP channel for confirmed publication closed:', text)
+		self.chan = None
+		if self.cnx is not None and self.cnx.is_open:
+			self.cnx.close ()
+		else:
+			self._lost (text)
+
+	def _lost (self, error):
+		"""The connection is gone, so the messages in flight failed.
+		"""
+		if len (self.pending) > 0:
+			log_error ('AMQP connection lost with', len (self.pending), 'unconfirmed messages:', error)
+			self.failed.extend ([ token for (msgid,token) in self.pending.values () ])
+		self.pending.clear ()
+		self.msgids.clear ()
+		self.returned.clear ()
+		self.cnx = None
+		self.chan = None
+		self.ready = False
+		self.error = error
+		self.ioloop.stop ()
+
+	def _on_return (self, chan, mth, props, body):
+		"""Take note of a returned message.  It will still be
+		   confirmed by the broker, but it is considered failed.
+		   The broker returns a message before it confirms it, so
+		   it is the oldest pending message with the message_id.
+		"""
+		tags = self.msgids.get (props.message_id)
+		if tags:
+			self.returned.add (tags [0])
+		else:
+			log_error ('Returned message is not pending:', mth.reply_text)
+
+	def _on_confirm (self, frame):
+		"""Process a Basic.Ack or Basic.Nack, possibly covering
+		   multiple messages up to and including the delivery_tag.
+		"""
+		mth = frame.method
+		nack = isinstance (mth, pika.spec.Basic.Nack)
+		if mth.multiple:
+			tags = [ ]
+			for tag in self.pending:
+				if tag > mth.delivery_tag:
+					break
+				tags.append (tag)
+		else:
+			tags = [ mth.delivery_tag ]
+		for tag in tags:
+			if not self.pending.has_key (tag):
+				continue
+			(msgid,token) = self.pending.pop (tag)
+			self.msgids [msgid].remove (tag)
+			if len (self.msgids [msgid]) == 0:
+				del self.msgids [msgid]
+			if nack or tag in self.returned:
+				self.failed.append (token)
+			self.returned.discard (tag)
+		self._check ()
+
+	def publish (self, exchange, routing_key, body, properties=None, mandatory=True, token=None):
+		"""Publish a message, waiting only when the window of
+		   messages in flight is full.  After a failure to connect,
+		   this raises an error until the next flush().
+		"""
+		if self.cnx is None:
+			if self.broken is not None:
+				raise pika.exceptions.AMQPConnectionError (self.broken)
+			self._open ()
+		if properties is None or properties.message_id is None:
+			properties = copy.copy (properties or pika.spec.BasicProperties ())
+			self.msgno += 1
+			properties.message_id = self.msgbase + str (self.msgno)
+		msgid = properties.message_id
+		self.chan.basic_publish (exchange, routing_key, body,
+				properties=properties, mandatory=mandatory)
+		self.seqno += 1
+		self.pending [self.seqno] = (msgid, token)
+		self.msgids.setdefault (msgid, [ ]).append (self.seqno)
+		self._run ()
+		self._run (lambda: len (self.pending) < self.window)
+
+	def flush (self):
+		"""Wait for all messages in flight to be confirmed.  Return
+		   the tokens of the messages that failed since the last
+		   flush.  When the connection breaks down, all messages
+		   that are still in flight are reported as failed.
+		"""
+		self._run (lambda: len (self.pending) == 0)
+		self.broken = None
+		failed = self.failed
+		self.failed = [ ]
+		return failed
+
+	def service (self):
+		"""Process pending events, including heartbeats.
+		"""
+		self._run ()
+
+	def close (self):
+		"""Close the connection, if it is open.
+		"""
+		if self.cnx is not None and self.cnx.is_open:
+			self.cnx.close ()
+			self._run (lambda: False)
+		self.cnx = None
+
+
 def open_client_connection (username=None, hostname='localhost'):
 	"""Return a connection as an AMQP client, with the given
 	   username.  A password is determined locally.  When
@@ -376,7 +2062,8 @@ def open_client_connection (username=None, hostname='localhost'):
 		virtual_host=vhost,
 		ssl=wrap_tls,
 		ssl_options=conf_tls,
-		credentials=creds
+		credentials=creds,
+		heartbeat=heartbeat
 	)
 	cnx = pika.BlockingConnection (cnxparm)
 	return cnx
@@ -10,13 +10,28 @@
 # DNSSEC signing policy to a domain.  The "default"
 # policy takes care of anything else.
 #
+# Zone updates are made by comparing the new unsigned zone with the
+# records that Knot DNS currently serves, and sending the difference
+# to knotc in one zone transaction.  The DNSSEC records that Knot DNS
+# adds while signing, and the SOA serial, are not compared.  The result
+# can be verified with another comparison, as set by [knot] verify to
+# always, sample (a verify_sample fraction of the updates) or off.
+#
 # From: Rick van Rein <rick@openfortress.nl>
 
 
 import os
+import random
+import subprocess
 
 import fcntl
 
+import dns.name
+import dns.zone
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+
 import rabbitdnssec
 from rabbitdnssec import log_debug, log_info, log_notice, log_warning, log_error, log_critical
 
@@ -24,6 +39,17 @@ cfg = rabbitdnssec.my_config ('knot')
 upload_dir   = cfg ['upload_dir']
 unsigned_dir = cfg ['unsigned_dir']
 signed_dir   = cfg ['signed_dir']
+verify_mode   =        cfg.get ('verify',        'always')
+verify_sample = float (cfg.get ('verify_sample', '0.1'))
+
+if verify_mode not in ['always', 'sample', 'off']:
+	raise Exception ('Knot DNS verify setting should be always, sample or off')
+
+#
+# The record types that Knot DNS manages while signing a zone.
+#
+dnssec_rdtypes = set ([ dns.rdatatype.from_text (t) for t in
+		[ 'RRSIG', 'NSEC', 'NSEC3', 'NSEC3PARAM', 'DNSKEY', 'CDS', 'CDNSKEY' ] ])
 
 
 #
@@ -92,28 +118,134 @@ def zone_del (zone):
 		log_error ('Knot DNS could not delete zone', zone)
 	global_lock.close ()
 
-# Update a zone being processed by Knot DNS
+# Return the key under which a record is compared.  This is the
+# owner name, the type and the record data, except that the serial
+# is left out of the SOA.  Records with the same key and another TTL
+# are replaced.
 #
-def zone_update (zone, new_zone_file, knot_zone_file):
-	tmp_zone_file = '/tmp/' + zone
-	log_debug ('CMD> /usr/sbin/knotc zone-read "' + zone + '" | sed \'s/^\[[^]]*\] *//\' > "' + tmp_zone_file + '"')
-	os.system ('/usr/sbin/knotc zone-read "' + zone + '" | sed \'s/^\[[^]]*\] *//\' > "' + tmp_zone_file + '"')
-	log_debug ('CMD> ldns-zonediff -k -o "' + zone + '" "' + tmp_zone_file + '" "' + new_zone_file + '" | /usr/sbin/knotc')
-	os.system ('ldns-zonediff -k -o "' + zone + '" "' + tmp_zone_file + '" "' + new_zone_file + '" | /usr/sbin/knotc')
-	# ignore previous result, but check the result
-	log_debug ('CMD> /usr/sbin/knotc zone-read "' + zone + '" | sed \'s/^\[[^]]*\] *//\' > "' + tmp_zone_file + '"')
-	os.system ('/usr/sbin/knotc zone-read "' + zone + '" | sed \'s/^\[[^]]*\] *//\' > "' + tmp_zone_file + '"')
-	log_debug ('CMD> ldns-zonediff -o "' + zone + '" "' + tmp_zone_file + '" "' + new_zone_file + '"')
-	exitval = os.system ('ldns-zonediff -o "' + zone + '" "' + tmp_zone_file + '" "' + new_zone_file + '"')
+def record_key (name, rdata):
+	if rdata.rdtype == dns.rdatatype.SOA:
+		cmp = (rdata.mname, rdata.rname, rdata.refresh, rdata.retry, rdata.expire, rdata.minimum)
+	else:
+		cmp = rdata
+	return (name, rdata.rdtype, cmp)
+
+# Return the records in a zone file as a dict mapping record_key()
+# to (name,ttl,rdata), without the DNSSEC records.
+#
+def zone_file_records (zone, path):
+	records = { }
+	zone_obj = dns.zone.from_file (path, origin=zone, relativize=False, allow_include=False)
+	for (name,ttl,rdata) in zone_obj.iterate_rdatas ():
+		if rdata.rdtype not in dnssec_rdtypes:
+			records [record_key (name, rdata)] = (name, ttl, rdata)
+	return records
+
+# Return the records that Knot DNS serves for a zone, as for
+# zone_file_records(), or None if the zone could not be read.
+# Lines of "knotc zone-read" look like
+#
+#	[example.com.] www.example.com. 3600 A 192.0.2.1
+#
+# and the type is checked before the data is parsed, so the many
+# records added by signing are skipped cheaply.
+#
+def zone_read (zone):
+	records = { }
+	knotc = subprocess.Popen (['/usr/sbin/knotc', 'zone-read', zone],
+			stdout=subprocess.PIPE)
+	try:
+		for line in knotc.stdout:
+			if line [:6] == 'error:':
+				continue
+			if line [:1] == '[':
+				line = line [line.index (']') + 1:]
+			words = line.split (None, 3)
+			if len (words) < 3:
+				continue
+			if words [2].upper () == 'IN':
+				words = words [:2] + words [3].split (None, 1)
+			rdtype = dns.rdatatype.from_text (words [2])
+			if rdtype in dnssec_rdtypes:
+				continue
+			name = dns.name.from_text (words [0])
+			rdata = dns.rdata.from_text (dns.rdataclass.IN, rdtype,
+					words [3] if len (words) > 3 else '',
+					origin=dns.name.root, relativize=False)
+			records [record_key (name, rdata)] = (name, int (words [1]), rdata)
+	finally:
+		knotc.stdout.close ()
+		exitval = knotc.wait ()
 	if exitval != 0:
+		log_error ('Knot DNS could not read zone', zone, '(%d)' % exitval)
+		return None
+	return records
+
+# Compare the old and new records, as returned by zone_read() and
+# zone_file_records(), and return lists of (name,ttl,rdata) that
+# should be removed and added.  Records are the same when their
+# record_key() and TTL are the same.
+#
+def zone_diff (old, new):
+	removed = [ old [k] for k in old if not new.has_key (k) or new [k][1] != old [k][1] ]
+	added   = [ new [k] for k in new if not old.has_key (k) or old [k][1] != new [k][1] ]
+	return (removed, added)
+
+# Send changes to Knot DNS in one zone transaction, through the
+# standard input of a single knotc process.  Return True when all
+# commands were accepted.
+#
+def zone_transaction (zone, removed, added):
+	cmds = [ 'zone-begin ' + zone ]
+	for (name,ttl,rdata) in removed:
+		cmds.append ('zone-unset %s %s %s %s' % (zone, name.to_text (), dns.rdatatype.to_text (rdata.rdtype), rdata.to_text ()))
+	for (name,ttl,rdata) in added:
+		cmds.append ('zone-set %s %s %d %s %s' % (zone, name.to_text (), ttl, dns.rdatatype.to_text (rdata.rdtype), rdata.to_text ()))
+	cmds.append ('zone-commit ' + zone)
+	log_debug ('CMD> /usr/sbin/knotc with', len (cmds), 'commands for', zone)
+	knotc = subprocess.Popen (['/usr/sbin/knotc'],
+			stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.STDOUT)
+	(output,_) = knotc.communicate (''.join ([ c + '\n' for c in cmds ]))
+	errors = [ l for l in output.split ('\n') if l [:6] == 'error:' ]
+	if knotc.returncode != 0 or len (errors) > 0:
+		log_error ('Knot DNS reported', ' '.join (errors) or 'failure', 'while updating zone', zone)
+		os.system ('/usr/sbin/knotc zone-abort "' + zone + '"')
+		return False
+	return True
+
+# Update a zone being processed by Knot DNS.  Return True when Knot DNS
+# serves the new zone file, or False when the update failed or when the
+# verification found a difference.
+#
+def zone_update (zone, new_zone_file, knot_zone_file):
+	new = zone_file_records (zone, new_zone_file)
+	old = zone_read (zone)
+	if old is None:
+		return False
+	(removed,added) = zone_diff (old, new)
+	log_debug ('Knot DNS update for', zone, 'removes', len (removed), 'and adds', len (added), 'records')
+	if len (removed) == 0 and len (added) == 0:
+		return True
+	if not zone_transaction (zone, removed, added):
+		return False
+	if verify_mode == 'off':
+		return True
+	if verify_mode == 'sample' and random.random () >= verify_sample:
+		return True
+	old = zone_read (zone)
+	if old is None or zone_diff (old, new) != ([], []):
 		log_error ('Knot DNS has not received/processed complete zone file update for', zone)
+		return False
+	return True
 
 
 #
 # Check if a zone is known
 #
 def zone_exists (zone_name=''):
-	if os.system ("knotc zone-read '" + zone_name + "' > /dev/null") != 0:
+	if not rabbitdnssec.my_knot_zone_inventory ().exists (zone_name):
 		log_error ('Have no zone for ', zone_name)
 		return False
 	else:
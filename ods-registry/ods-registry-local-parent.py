@@ -24,23 +24,20 @@ exchange_name = rabbitdnssec.my_exchange ('parenting')
 
 
 #
-# Return a socket / handle for the connection to the local parent
+# Return a socket / handle for the connection to the local parent.
+# The connection is shared between passes; only the channel is new.
 #
 def connect ():
 	#
 	# Create the queueing infrastructure for the parent exchange.
 	#
-	creds = rabbitdnssec.my_credentials (ovr_username='parenting')
-	cnxparm = rabbitdnssec.my_connectionparameters (creds)
-	intcnx = None
-	chan = None
+	amqp = rabbitdnssec.my_connection (ovr_username='parenting')
 	try:
-		intcnx = pika.BlockingConnection (cnxparm)
-		chan = intcnx.channel ()
+		chan = amqp.channel ()
 		#TODO:CLASS# chan.basic_consume (process_msg, queue=queue_name)
 		#TODO:NOTHERE# chan.tx_select ()
 		#TODO:CLASS# chan.start_consuming ()
-		return (intcnx,chan)
+		return (amqp,chan)
 	except pika.exceptions.AMQPChannelError, e:
 		log_error ('AMQP Channel Error:', e)
 		sys.exit (1)
@@ -49,33 +46,33 @@ def connect ():
 		sys.exit (1)
 
 #
-# Terminate any outstanding connection to the local parent
+# Terminate any outstanding channel to the local parent.
+# The shared connection stays open for the next pass.
 #
 def disconnect (cnx):
-	(intcnx,chan) = cnx
-	#
-	# To end this program, unwind all instances and unregister our own
-	# callback to cb_uploaded_hint().
-	#
-	chan.basic_cancel (uploaded_hints_tag)
-	for pex in parenting_exchange.values ():
-		pex.close ()
+	(amqp,chan) = cnx
+	try:
+		chan.close ()
+	except pika.exceptions.AMQPError, e:
+		log_warning ('AMQP Error while closing channel:', e)
 	chan = None
-	intcnx.close ()
-	intcnx = None
 
 #
 # Pass a set of DNSSEC keys to the parent
 #
 def update_keys (cnx, domain, keys):
-	(intcnx,chan) = cnx
+	(amqp,chan) = cnx
 	dnskeys = map (lambda k: '3600 IN DNSKEY ' + k.to_text (), keys)
 	msg = ''.join (dnskeys).strip ()
 	domnodot = domain.to_text ()
 	if domnodot.endswith ('.'):
 		domnodot = domnodot [:-1]
 	log_info ('Local "registry" update with zone', domnodot, 'keys', msg)
+	wire = rabbitdnssec.parenting_format == 'wire' and len (keys) > 0
+	if wire:
+		msg = rabbitdnssec.rrset_wire (domain, 3600, keys)
 	chan.basic_publish (exchange=exchange_name,
 			routing_key=domnodot,
-			body=msg)
+			body=msg,
+			properties=rabbitdnssec.parenting_properties (wire))
 
@@ -13,27 +13,15 @@ zonelist_filename = cfg ['opendnssec']
 #
 # Start of code, imports
 #
-from lxml import etree
+import os
 
 
 #
-# Return the set of zone names
+# Return the set of zone names; the zone list file is only parsed
+# again after it has changed
 #
 def zonenames ():
-	#
-	# Read the zone list file
-	zonelist = open (zonelist_filename)
-	zones = etree.parse (zonelist).getroot ()
-	zonelist.close ()
-	#
-	# Collect the zone names mentioned in the zone list
-	workset = set ()
-	for zone in zones:
-		if zone.tag != 'Zone':
-			raise Exception ('Found something else than a Zone in the zonelist file ' + zonelist_filename)
-		work = zone.attrib ['name']
-		workset.add (work)
-	return workset
+	return set (rabbitdnssec.zonelist_names (zonelist_filename))
 
 
 #
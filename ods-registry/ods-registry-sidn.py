@@ -275,7 +275,7 @@ def keydata_xmlstring (key):
 # provided to indicate if an optional <secDNS:keyData/> should be embedded.
 #
 def dsdata_xmlstring (zone, key, alg='SHA1', embedkeydata=True):
-	keyds = dns.dnssec.make_ds (zone, key, alg)
+	keyds = rabbitdnssec.ds_cache.make_ds (zone, key, alg)
 	hexdigest = ''
 	for c in keyds.digest:
 		hexdigest = hexdigest + ('%02x' % ord (c))
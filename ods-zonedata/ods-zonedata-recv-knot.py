@@ -8,6 +8,11 @@
 # ods-keyops-knot-delkey, to add and remove keys orthogonally, in
 # spite of Knot DNS resisting such an approach.
 #
+# Zones are added and removed in batches through updatezones(), so a
+# whole batch costs only one configuration commit, and therefore only
+# one configuration reload in Knot DNS.  The zones that were committed
+# are passed on to the inventory of Knot DNS zones.
+#
 # From: Rick van Rein <rick@openfortress.nl>
 
 
@@ -20,77 +25,111 @@ import rabbitdnssec
 from rabbitdnssec import log_debug, log_info, log_notice, log_warning, log_error, log_critical
 
 
-def addzone (zone, zonedata):
-	# Ensure that a zone is served by Knot DNS.
+def updatezones (adds, dels):
+	# Add and remove zones in one configuration transaction of Knot
+	# DNS.  The additions are given as a list of (zone,zonedata) and
+	# the removals as a list of zones.  The zones that failed are
+	# returned, after their changes have been taken out of the
+	# transaction again.
+	#
 	# Note: Key setup and DNSSEC signing is orthogonally setup;
 	# it defaults to being off, so an unsigned zone is delivered.
 	#
 	# Note: This procedure is idempotent, zone additions are neutral
-	# for already-existing zones.
-	#
-	# Note: Zone addition is not done in the parenting procedure,
-	# as it makes little sense there without actual zone data (with,
-	# at minimum, the SOA record).  The parenting exchange will get
-	# a hint when we add a zone though, so it can append any child
-	# name server records as soon as we add the zone.
+	# for already-existing zones, and zones that are already absent
+	# are silently accepted for removal.
 	#
-	global_lock = open ('/tmp/knotc-global-lock', 'w')
-	fcntl.lockf (global_lock, fcntl.LOCK_EX)
-	rv0 = os.system ('/usr/sbin/knotc conf-begin')
-	rv1 = 0
-	rv2 = 0
-	if rv0==0:
-		os.system ('/usr/sbin/knotc conf-set zone.domain "' + zone + '"')
-		# Ignore the result; the zone may already exist; check that
-		rv1 =  os.system ('/usr/sbin/knotc conf-get "zone[' + zone + ']"')
-	if rv0==0 and rv1==0:
-		try:
-			knot_signed = '/var/opendnssec/signed/' + zone + '.txt'
-			shared = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
-			fd = open (knot_signed, 'w')
-			fd.write (zonedata)
-			fd.close ()
-			os.chmod (knot_signed, shared)
-			rv2 = os.system ('/usr/sbin/knotc conf-set "zone[' + zone + '].file" "' + knot_signed + '"')
-		except:
-			rv2 = 2
-	if rv0==0 and rv1==0 and rv2==0:
-		os.system ('/usr/sbin/knotc conf-commit')
-		log_debug ('CMD> ods-keyops-knot-sharekey "' + zone + '"')
-		os.system ('ods-keyops-knot-sharekey "' + zone + '"')
-	else:
-		if rv0==0:
-			os.system ('/usr/sbin/knotc conf-abort')
-		log_error ('Knot DNS could not add zone', zone, '(%d,%d,%d)' % (rv0,rv1,rv2))
-	global_lock.close ()
-
-def delzone (zone):
-	# Remove a zone from Knot DNS, so it is no longer served.
 	# Note: The removal is even done when key material still
 	# exists.  In this case, the zone is no longer delivered
 	# but the key material is assumed to be cleaned up by an
 	# orthogonal process [that will shrug if the zone has
 	# been removed already].
 	#
-	# Note: Zone deletion is not done in the parenting procedure,
-	# as it can silently ignore the case of a deleted zone (for which
-	# we need, at minimum, the SOA record).  The parenting exchange
-	# needs no hint when we delete a zone.
+	# Note: Zone addition is not done in the parenting procedure,
+	# as it makes little sense there without actual zone data (with,
+	# at minimum, the SOA record).  The parenting exchange will get
+	# a hint when we add a zone though, so it can append any child
+	# name server records as soon as we add the zone.  Zone deletion
+	# is not done in the parenting procedure either, as it can silently
+	# ignore the case of a deleted zone.  The parenting exchange needs
+	# no hint when we delete a zone.
 	#
+	if len (adds) + len (dels) == 0:
+		return []
 	global_lock = open ('/tmp/knotc-global-lock', 'w')
 	fcntl.lockf (global_lock, fcntl.LOCK_EX)
 	rv0 = os.system ('/usr/sbin/knotc conf-begin')
-	rv1 = 0
-	rv2 = 0
-	if rv0==0:
-		rv1 = os.system ('/usr/sbin/knotc conf-unset zone.domain "' + zone + '"')
-	if rv0==0 and rv1==0:
-		rv2 = os.system ('/usr/sbin/knotc -f zone-purge "' + zone + '"')
-	if rv0==0 and rv1==0 and rv2==0:
-		os.system ('/usr/sbin/knotc conf-commit')
-	else:
-		if rv0==0:
-			os.system ('/usr/sbin/knotc conf-abort')
-		log_error ('Knot DNS could not delete zone', zone, '(%d,%d,%d)' % (rv0,rv1,rv2))
+	if rv0 != 0:
+		log_error ('Knot DNS could not update zones', ' '.join ([ z for (z,_) in adds ] + dels), '(%d)' % rv0)
+		global_lock.close ()
+		return [ z for (z,_) in adds ] + list (dels)
+	failed = []
+	changed = 0
+	added = []
+	for (zone,zonedata) in adds:
+		existed = os.system ('/usr/sbin/knotc conf-get "zone[' + zone + ']"') == 0
+		rv1 = 0
+		rv2 = 0
+		if not existed:
+			os.system ('/usr/sbin/knotc conf-set zone.domain "' + zone + '"')
+			rv1 = os.system ('/usr/sbin/knotc conf-get "zone[' + zone + ']"')
+		if rv1==0:
+			try:
+				knot_signed = '/var/opendnssec/signed/' + zone + '.txt'
+				shared = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
+				fd = open (knot_signed, 'w')
+				fd.write (zonedata)
+				fd.close ()
+				os.chmod (knot_signed, shared)
+				rv2 = os.system ('/usr/sbin/knotc conf-set "zone[' + zone + '].file" "' + knot_signed + '"')
+			except:
+				rv2 = 2
+		if rv1!=0 or rv2!=0:
+			if not existed:
+				os.system ('/usr/sbin/knotc conf-unset "zone[' + zone + ']"')
+			log_error ('Knot DNS could not add zone', zone, '(%d,%d,%d)' % (rv0,rv1,rv2))
+			failed.append (zone)
+		else:
+			added.append (zone)
+			changed += 1
+	removed = []
+	for zone in dels:
+		if os.system ('/usr/sbin/knotc conf-get "zone[' + zone + ']"') != 0:
+			removed.append (zone)
+			continue
+		# Purge before the removal, so a zone that cannot be
+		# purged keeps its configuration, as it did before
+		rv1 = os.system ('/usr/sbin/knotc -f zone-purge "' + zone + '"')
+		rv2 = 0
+		if rv1==0:
+			rv2 = os.system ('/usr/sbin/knotc conf-unset zone.domain "' + zone + '"')
+		if rv1!=0 or rv2!=0:
+			log_error ('Knot DNS could not delete zone', zone, '(%d,%d,%d)' % (rv0,rv1,rv2))
+			failed.append (zone)
+		else:
+			removed.append (zone)
+			changed += 1
+	if changed == 0:
+		os.system ('/usr/sbin/knotc conf-abort')
+	elif os.system ('/usr/sbin/knotc conf-commit') != 0:
+		os.system ('/usr/sbin/knotc conf-abort')
+		log_error ('Knot DNS could not commit the update of zones', ' '.join (added + removed))
+		global_lock.close ()
+		return [ z for (z,_) in adds ] + list (dels)
 	global_lock.close ()
+	rabbitdnssec.my_knot_zone_inventory ().update (added=added, removed=removed)
+	if len (added) > 0:
+		rabbitdnssec.run_helper ('ods-keyops-knot-sharekey', *added)
+	return failed
 
+def addzones (zones):
+	return updatezones (zones, [])
+
+def delzones (zones):
+	return updatezones ([], zones)
+
+def addzone (zone, zonedata):
+	addzones ([ (zone,zonedata) ])
+
+def delzone (zone):
+	delzones ([ zone ])
@@ -5,6 +5,9 @@
 # (in an atomic manner) for use with OpenDNSSEC.  This is a backend
 # for the general ods-zonedata-recv logic.
 #
+# The zonelist.xml is held in memory and written once for every batch
+# of zones that is added or removed.
+#
 # From: Rick van Rein <rick@openfortress.nl>
 
 
@@ -18,52 +21,134 @@ import rabbitdnssec
 #
 cfg = rabbitdnssec.my_config ('opendnssec')
 zonelist_file = cfg ['zonelist_file']
-zonelist_file_tmp = zonelist_file + '.writing.' + str (os.getpid ())
 
 
 import xml.etree.ElementTree as ET
 
 
+class ZoneList (object):
+
+	"""ZoneList holds the zonelist.xml in memory, with an index from
+	   zone names to their Zone elements.  Zones are added and removed
+	   in memory, and flush() writes the file with an atomic rename.
+	   No need to lock; this is the only process writing zonelist.xml.
+	   When the file was changed by someone else, it is loaded again
+	   before the next change.
+	"""
+
+	def __init__ (self, path):
+		self.path = path
+		self.tmppath = path + '.writing.' + str (os.getpid ())
+		self.load ()
+
+	def load (self):
+		self.tree = ET.parse (self.path)
+		self.zones = { }
+		for zelem in self.tree.getroot ().findall ('Zone'):
+			self.zones [zelem.get ('name')] = zelem
+		self.stamp = rabbitdnssec.file_stamp (self.path)
+		self.dirty = False
+
+	def refresh (self):
+		"""Load the file again if it was changed by someone else.
+		"""
+		if not self.dirty and rabbitdnssec.file_stamp (self.path) != self.stamp:
+			rabbitdnssec.log_info ('Reloading changed', self.path)
+			self.load ()
+
+	def forget (self):
+		"""Drop changes that were not flushed, and load the file
+		   again before the next change.
+		"""
+		self.stamp = None
+		self.dirty = False
+
+	def add (self, zone):
+		if self.zones.has_key (zone):
+			# Silently accept that the zone already exists
+			return
+		zdict = {
+			'name': zone,
+			'Policy': 'SURFdomeinen',
+			'SignerConfiguration': '/var/opendnssec/signconf/' + zone + '.signconf'
+		}
+		zelem = ET.Element ('Zone', zdict)
+		zadap = ET.SubElement (zelem, 'Adapters', {})
+		zadin = ET.SubElement (zadap, 'Input', {})
+		zadot = ET.SubElement (zadap, 'Output', {})
+		zadif = ET.SubElement (zadin, 'File', {})
+		zadif.text = '/var/opendnssec/unsigned/' + zone + '.txt'
+		zadof = ET.SubElement (zadot, 'File', {})
+		zadof.text = '/var/named/chroot/var/named/opendnssec/' + zone
+		self.tree.getroot ().append (zelem)
+		self.zones [zone] = zelem
+		self.dirty = True
+
+	def remove (self, zone):
+		zelem = self.zones.pop (zone, None)
+		if zelem is None:
+			# Silently accept that the zone was already removed
+			return
+		self.tree.getroot ().remove (zelem)
+		self.dirty = True
+
+	def flush (self):
+		"""Write the changes, if any, with an atomic rename;
+		   asynchronous reads are still possible.
+		"""
+		if not self.dirty:
+			return
+		self.tree.write (self.tmppath)
+		os.rename (self.tmppath, self.path)
+		self.stamp = rabbitdnssec.file_stamp (self.path)
+		self.dirty = False
+
+zonelist = ZoneList (zonelist_file)
+
+
+# Apply changes to the zonelist and flush them, or return all zones as
+# failed, and drop the changes, when the zonelist cannot be written.
+# The changes are a list of (zone,change,what) with change(zone) the
+# operation on the zonelist and what its name for error messages.
+#
+def update_zonelist (changes):
+	failed = []
+	try:
+		zonelist.refresh ()
+		for (zone,change,what) in changes:
+			try:
+				change (zone)
+			except Exception, e:
+				rabbitdnssec.log_error ('Failed to', what, zone, 'in zonelist:', e)
+				failed.append (zone)
+		zonelist.flush ()
+	except Exception, e:
+		rabbitdnssec.log_error ('Failed to update zones in', zonelist_file + ':', e)
+		zonelist.forget ()
+		return [ zone for (zone,change,what) in changes ]
+	return failed
+
+
 def addzone (zone, zonedata):
-	# No need to lock; this is the only process writing zonelist.xml
-	tree = ET.parse (zonelist_file)
-	zlist = tree.getroot ()
-	zelem = zlist.find ('Zone[@name=\'' + zone + '\']')
-	if zelem is not None:
-		# Silently accept that the zone already exists
-		return
-	zdict = {
-		'Policy': 'SURFdomeinen',
-		'SignerConfiguration': '/var/opendnssec/signconf/' + zone + '.signconf'
-	}
-	zelem = ET.Element ('Zone', zdict)
-	zlist.append (zelem)
-	zadap = ET.Element ('Adapters', {})
-	zelem.append (zadap)
-	zadin = ET.Element ('Input', {})
-	zadap.append (zadin)
-	zadot = ET.Element ('Output', {})
-	zadap.append (zadot)
-	zadif = ET.Element ('File', {})
-	zadif.text = '/var/opendnssec/unsigned/' + zone + '.txt'
-	zadin.append (zadif)
-	zadof = ET.Element ('File', {})
-	zadof.txt = '/var/named/chroot/var/named/opendnssec/' + zone
-	zadot.append (zadof)
-	# Need to be atomic; asynchronous reads are still possible
-	tree.write (zonelist_file_tmp)
-	os.rename (zonelist_file_tmp, zonelist_file)
+	if len (addzones ([ (zone,zonedata) ])) > 0:
+		raise Exception ('Failed to add ' + zone + ' to zonelist')
 
 def delzone (zone):
-	# No need to lock; this is the only process writing zonelist.xml
-	tree = ET.parse (zonelist_file)
-	zlist = tree.getroot ()
-	zelem = zlist.find ('Zone[@name=\'' + zone + '\']')
-	if zelem is None:
-		# Silently accept that the zone was already removed
-		return
-	zlist.remove (zelem)
-	# Need to be atomic; asynchronous reads are still possible
-	tree.write (zonelist_file_tmp)
-	os.rename (zonelist_file_tmp, zonelist_file)
+	if len (delzones ([ zone ])) > 0:
+		raise Exception ('Failed to remove ' + zone + ' from zonelist')
+
+
+def updatezones (adds, dels):
+	# Add a list of (zone,zonedata) and remove a list of zones with
+	# one write of the zonelist, and return the zones that failed
+	return update_zonelist (
+		[ (zone, zonelist.add,    'add'   ) for (zone,zonedata) in adds ] +
+		[ (zone, zonelist.remove, 'remove') for zone in dels ])
+
+def addzones (zones):
+	# Add a list of (zone,zonedata) and return the zones that failed
+	return updatezones (zones, [])
 
+def delzones (zones):
+	# Remove a list of zones and return the ones that failed
+	return updatezones ([], zones)